@@ -15,13 +15,19 @@ def generate_sine_wave(
     """
     Generate a sine wave as a numpy array.
     """
-    t = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
-    wave = amplitude * np.sin(2 * np.pi * frequency * t)
+    num_samples = int(sample_rate * duration)
 
+    # Build the wave in place from the sample indices to avoid temporaries
+    wave = np.arange(num_samples, dtype=np.float64)
+    wave *= 2 * np.pi * frequency / sample_rate
+    np.sin(wave, out=wave)
+    wave *= amplitude
+
+    # Always clip to the int16 range, so loud waves saturate instead of wrapping around
+    max_amplitude = np.iinfo(np.int16).max
     if clip_amplitude != None:
-        clip_amplitude = np.int16(clip_amplitude)
-        wave[wave > clip_amplitude] = clip_amplitude
-        wave[wave < -clip_amplitude] = -clip_amplitude
+        max_amplitude = min(clip_amplitude, max_amplitude)
+    np.clip(wave, -max_amplitude, max_amplitude, out=wave)
 
     wave = np.int16(wave)
 
@@ -37,8 +43,8 @@ def save_to_wav(filepath: Path, samples: np.ndarray, sample_rate: int):
 
 
 def play(samples: np.ndarray, sample_rate: int):
-    # Convert int16 samples to float32 in the range [-1.0, 1.0]
-    float_samples = samples.astype(np.float32) / np.iinfo(np.int16).max
+    # Convert int16 samples to float32 in the range [-1.0, 1.0], in a single pass
+    float_samples = np.divide(samples, np.iinfo(np.int16).max, dtype=np.float32)
 
     # Play the sound
     sd.play(float_samples, sample_rate)
@@ -2,21 +2,63 @@
 A fun little script that explores fast fourier transform, and inverse fast fourier transform.
 
 It takes an audio file, converts it to a spectrogram, and then reconstructs the audio from the spectrogram.
+Pass --reference to do the transforms with the in-house FFT instead of scipy's.
 
 To run:
-    python <input_file.wav> <output_spectrgram_file.png> <output_reconstructed_audio_file.wav>
+    python fft.py [--reference] <input_file.wav> <output_spectrgram_file.png> <output_reconstructed_audio_file.wav>
 """
 
+from functools import lru_cache
 import numpy as np
+from scipy.fft import rfft, irfft
 from PIL import Image
 from PIL import PngImagePlugin
 import soundfile as sf
 import sys
 
 
+@lru_cache(maxsize=None)
+def bit_reversal_permutation(N: int) -> np.ndarray:
+    """
+    Computes the indices that put an array of size N (a power of 2) in bit-reversed order.
+
+    Args:
+    N (int): Size of the array.
+
+    Returns:
+    np.ndarray: Permutation indices.
+    """
+    indices = np.zeros(1, dtype=np.intp)
+    while len(indices) < N:
+        # Reversing one more bit puts the new bit at the bottom
+        indices = np.concatenate([2 * indices, 2 * indices + 1])
+
+    # The result is cached, so don't let callers modify it
+    indices.flags.writeable = False
+    return indices
+
+
+@lru_cache(maxsize=None)
+def twiddle_factors(N: int) -> np.ndarray:
+    """
+    Computes the twiddle factors exp(-2j*pi*k/N), for k in [0, N/2), used by a size-N FFT.
+
+    Args:
+    N (int): Size of the FFT.
+
+    Returns:
+    np.ndarray: Twiddle factors.
+    """
+    twiddles = np.exp(-2j * np.pi * np.arange(N // 2) / N)
+
+    # The result is cached, so don't let callers modify it
+    twiddles.flags.writeable = False
+    return twiddles
+
+
 def ditfft2(x: np.ndarray, N: int, s: int) -> np.ndarray:
     """
-    Recursive implementation of radix-2 DIT FFT.
+    Iterative, in-place implementation of radix-2 DIT FFT.
     Adapted from pseudocode from here: https://en.wikipedia.org/wiki/Cooley%E2%80%93Tukey_FFT_algorithm
 
     Args:
@@ -27,21 +69,36 @@ def ditfft2(x: np.ndarray, N: int, s: int) -> np.ndarray:
     Returns:
     np.ndarray: The DFT of the input array x.
     """
-    if N == 1:
-        return np.array([x[0]], dtype=complex)
-
-    # DFT of the even-indexed elements
-    X_even = ditfft2(x, N // 2, 2 * s)
-
-    # DFT of the odd-indexed elements
-    X_odd = ditfft2(x[s:], N // 2, 2 * s)
-
-    # Combine the results
-    X = np.zeros(N, dtype=complex)
-    for k in range(N // 2):
-        twiddle = np.exp(-2j * np.pi * k / N) * X_odd[k]
-        X[k] = X_even[k] + twiddle
-        X[k + N // 2] = X_even[k] - twiddle
+    # Radix-2 only works for powers of 2. The default scipy.fft path picks a
+    # mixed-radix decomposition, so use that for any other size.
+    if N < 1 or N & (N - 1):
+        raise ValueError(f"FFT size must be a power of 2: {N}")
+
+    # Pick every s-th element, in bit-reversed order
+    X = np.asarray(x[: N * s : s], dtype=complex)[bit_reversal_permutation(N)]
+
+    twiddles = twiddle_factors(N)
+
+    # Combine pairs of size-m DFTs into size-2m DFTs until the whole array is done
+    m = 1
+    if N > 1:
+        # The size-2 DFTs only have a twiddle factor of 1, so skip the multiply
+        pairs = X.reshape(-1, 2)
+        odd = pairs[:, 1].copy()
+        pairs[:, 1] = pairs[:, 0] - odd
+        pairs[:, 0] += odd
+        m = 2
+
+    while m < N:
+        # exp(-2j*pi*k/(2m)) is every (N/2m)-th size-N twiddle
+        stage_twiddles = twiddles[:: N // (2 * m)]
+
+        # Each row holds one pair: even DFT in the first half, odd DFT in the second
+        pairs = X.reshape(-1, 2 * m)
+        odd = pairs[:, m:] * stage_twiddles
+        pairs[:, m:] = pairs[:, :m] - odd
+        pairs[:, :m] += odd
+        m *= 2
 
     return X
 
@@ -74,7 +131,7 @@ def inverse_ditfft2(X: np.ndarray, N: int, s: int) -> np.ndarray:
 
 
 def audio_to_spectrogram(
-    audio_data: np.ndarray, window_size: int, overlap: int, fft_func
+    audio_data: np.ndarray, window_size: int, overlap: int, fft_func=None
 ) -> np.ndarray:
     """
     Computes a 2D spectrogram using the FFT function.
@@ -83,29 +140,31 @@ def audio_to_spectrogram(
     audio_data (np.ndarray): Input audio signal.
     window_size (int): Size of each FFT window (number of samples per window).
     overlap (int): Overlap between consecutive windows (in samples).
-    fft_func (function): FFT function to use.
+    fft_func (function, optional): FFT function to apply to each window.
+        Defaults to transforming all windows at once with scipy.fft.rfft.
 
     Returns:
     np.ndarray: Spectrogram as a 2D array (time x frequency).
     """
     step_size = window_size - overlap
-    num_windows = (len(audio_data) - window_size) // step_size + 1
-    spectrogram = []
 
-    for i in range(num_windows):
-        # Extract the windowed portion of the audio signal
-        start_idx = i * step_size
-        end_idx = start_idx + window_size
-        window_data = audio_data[start_idx:end_idx]
+    # View every window of the audio signal as a row, without copying
+    windows = np.lib.stride_tricks.sliding_window_view(audio_data, window_size)
+    windows = windows[::step_size]
 
-        # Apply FFT to the window
-        fft_result = fft_func(window_data, window_size, 1)
+    if fft_func is None:
+        # Apply FFT to all windows in a single call, split across all CPU cores
+        magnitudes = np.abs(rfft(windows, axis=1, workers=-1))
+    else:
+        magnitudes = np.empty((len(windows), window_size // 2 + 1))
+        for i, window_data in enumerate(windows):
+            # Apply FFT to the window
+            fft_result = fft_func(window_data, window_size, 1)
 
-        # Compute magnitude and add to the spectrogram
-        magnitude = np.abs(fft_result[: window_size // 2 + 1])
-        spectrogram.append(magnitude)
+            # Compute magnitude straight into the spectrogram
+            np.abs(fft_result[: window_size // 2 + 1], out=magnitudes[i])
 
-    return np.array(spectrogram).T  # Transpose so that rows represent frequencies
+    return magnitudes.T  # Transpose so that rows represent frequencies
 
 
 def save_spectrogram(
@@ -120,17 +179,26 @@ def save_spectrogram(
     meta.add_text("overlap", str(overlap))
     meta.add_text("sample_rate", str(sample_rate))
 
-    log_spectrogram = 10 * np.log10(spectrogram + 1e-6)
-    meta.add_text("min", str(log_spectrogram.min()))
-    meta.add_text("max", str(log_spectrogram.max()))
-    # Normalize the spectrogram to the range [0, 255] for grayscale representation
-    log_spectrogram -= log_spectrogram.min()
-    log_spectrogram /= log_spectrogram.max()
-    log_spectrogram *= 255
+    # Convert to a log scale, reusing one buffer for every step
+    log_spectrogram = spectrogram + 1e-6
+    np.log10(log_spectrogram, out=log_spectrogram)
+    log_spectrogram *= 10
 
-    # Create an image from the data and save it
-    image = Image.fromarray(log_spectrogram.astype(np.uint8))
-    image.save(filename, "png", pnginfo=meta)
+    log_spectrogram_min = log_spectrogram.min()
+    log_spectrogram_max = log_spectrogram.max()
+    meta.add_text("min", str(log_spectrogram_min))
+    meta.add_text("max", str(log_spectrogram_max))
+    # Normalize the spectrogram to the range [0, 65535] for 16-bit grayscale
+    # representation, which keeps far more detail than 8 bits for reconstruction
+    max_level = np.iinfo(np.uint16).max
+    meta.add_text("max_level", str(max_level))
+    log_spectrogram -= log_spectrogram_min
+    log_spectrogram /= log_spectrogram_max - log_spectrogram_min
+    log_spectrogram *= max_level
+
+    # Create an image from the data and save it, favoring fast compression
+    image = Image.fromarray(log_spectrogram.astype(np.uint16))
+    image.save(filename, "png", pnginfo=meta, compress_level=1)
 
 
 def load_spectrogram(filename: str):
@@ -153,11 +221,13 @@ def load_spectrogram(filename: str):
     sample_rate = int(meta.get("sample_rate"))
     log_spectrogram_min = float(meta.get("min"))
     log_spectrogram_max = float(meta.get("max"))
+    # Spectrograms saved before 16-bit support are 8-bit, without this entry
+    max_level = int(meta.get("max_level", 255))
 
     # Read the image data and convert back to the original log_spectrogram
     log_spectrogram_normalized = np.array(image)
     log_spectrogram = log_spectrogram_normalized.astype(np.float32)
-    log_spectrogram /= 255
+    log_spectrogram /= max_level
     log_spectrogram *= log_spectrogram_max - log_spectrogram_min
     log_spectrogram += log_spectrogram_min
 
@@ -167,86 +237,142 @@ def load_spectrogram(filename: str):
     return spectrogram, window_size, overlap, sample_rate
 
 
+def overlap_add(frames: np.ndarray, step_size: int) -> np.ndarray:
+    """
+    Sums frames into a single signal, starting each frame step_size samples after the previous one.
+
+    Args:
+    frames (np.ndarray): 2D array with one frame per row.
+    step_size (int): Distance between the starts of consecutive frames (in samples).
+
+    Returns:
+    np.ndarray: Overlap-added signal.
+    """
+    num_frames, frame_size = frames.shape
+    # Leave room for a full step after the last frame, and trim it off at the end
+    signal = np.zeros(num_frames * step_size + frame_size, dtype=frames.dtype)
+
+    # Add the frames one step-sized chunk at a time. Chunks at the same offset
+    # never overlap each other, so each offset is a single vectorized add.
+    for offset in range(0, frame_size, step_size):
+        chunk = frames[:, offset : offset + step_size]
+        rows = signal[offset : offset + num_frames * step_size].reshape(num_frames, step_size)
+        rows[:, : chunk.shape[1]] += chunk
+
+    return signal[: (num_frames - 1) * step_size + frame_size]
+
+
+@lru_cache(maxsize=None)
+def hanning_window_sum(
+    window_size: int, step_size: int, num_windows: int, dtype: np.dtype
+) -> tuple:
+    """
+    Computes the Hanning window, and the sum of all its overlapping copies across a signal.
+
+    Args:
+    window_size (int): Size of the window (in samples).
+    step_size (int): Distance between the starts of consecutive windows (in samples).
+    num_windows (int): Number of windows in the signal.
+    dtype (np.dtype): Data type of the results.
+
+    Returns:
+    tuple: (hanning_window, window_sum)
+    """
+    hanning_window = np.hanning(window_size).astype(dtype)
+    window_sum = overlap_add(
+        np.broadcast_to(hanning_window, (num_windows, window_size)), step_size
+    )
+
+    # The results are cached, so don't let callers modify them
+    hanning_window.flags.writeable = False
+    window_sum.flags.writeable = False
+    return hanning_window, window_sum
+
+
 def spectrogram_to_audio(
-    spectrogram: np.ndarray, window_size: int, overlap: int
+    spectrogram: np.ndarray, window_size: int, overlap: int, ifft_func=None
 ) -> np.ndarray:
     """
-    Reconstructs audio from a spectrogram using an in-house inverse FFT,
+    Reconstructs audio from a spectrogram using an inverse FFT,
     applying the Hanning window during reconstruction.
 
     Args:
         spectrogram (np.ndarray): Input spectrogram (magnitude only).
         window_size (int): Size of each FFT window (number of samples per window).
         overlap (int): Overlap between consecutive windows (in samples).
-        sample_rate (int): Sample rate of the audio signal.
+        ifft_func (function, optional): Inverse FFT function to apply to each window.
+            Defaults to transforming all windows at once with scipy.fft.irfft.
 
     Returns:
         np.ndarray: Reconstructed audio signal.
     """
     step_size = window_size - overlap
     num_windows = spectrogram.shape[1]
-    audio_length = num_windows * step_size + overlap
-    audio_data = np.zeros(audio_length)
-    window_sum = np.zeros(audio_length)
-
-    # Precompute the Hanning window
-    hanning_window = np.hanning(window_size)
-
-    for i in range(num_windows):
-        # Get magnitude spectrum
-        magnitude = spectrogram[:, i]
-        # Assume zero phase
-        phase = np.zeros_like(magnitude)
-        # Construct the complex spectrum
-        positive_freqs = magnitude * np.exp(1j * phase)
-        # Reconstruct the full spectrum
-        full_spectrum = np.concatenate([positive_freqs, positive_freqs[-2:0:-1].conj()])
-        time_signal = inverse_ditfft2(full_spectrum, window_size, 1).real
-
-        # Apply the Hanning window
-        time_signal *= hanning_window
-
-        # Overlap-add
-        start_idx = i * step_size
-        end_idx = start_idx + window_size
-        audio_data[start_idx:end_idx] += time_signal
-        window_sum[start_idx:end_idx] += hanning_window
-
-    nonzero_indices = window_sum > 1e-6
-    audio_data[nonzero_indices] /= window_sum[nonzero_indices]
+
+    # Assume zero phase, so each window's spectrum is just its magnitudes
+    magnitudes = spectrogram.T
+
+    if ifft_func is None:
+        # Apply inverse FFT to all windows in a single call, split across all CPU cores
+        time_signals = irfft(magnitudes, n=window_size, axis=1, workers=-1)
+    else:
+        time_signals = np.empty((num_windows, window_size), dtype=magnitudes.dtype)
+        full_spectrum = np.empty(window_size, dtype=complex)
+        num_positive_freqs = magnitudes.shape[1]
+        for i, magnitude in enumerate(magnitudes):
+            # Reconstruct the full spectrum, mirroring the positive frequencies
+            full_spectrum[:num_positive_freqs] = magnitude
+            full_spectrum[num_positive_freqs:] = magnitude[-2:0:-1]
+            time_signals[i] = ifft_func(full_spectrum, window_size, 1).real
+
+    # Apply the Hanning window
+    hanning_window, window_sum = hanning_window_sum(
+        window_size, step_size, num_windows, time_signals.dtype
+    )
+    time_signals *= hanning_window
+
+    audio_data = overlap_add(time_signals, step_size)
+    np.divide(audio_data, window_sum, out=audio_data, where=window_sum > 1e-6)
 
     return audio_data
 
 
 def main():
-    if len(sys.argv) != 4:
+    args = sys.argv[1:]
+    use_reference_fft = "--reference" in args
+    if use_reference_fft:
+        args.remove("--reference")
+
+    if len(args) != 3:
         print(
-            "Usage: python script.py <input_audio_file> <output_image_file> <output_audio_file>"
+            "Usage: python script.py [--reference] <input_audio_file> <output_image_file> <output_audio_file>"
         )
         sys.exit(1)
 
-    input_audio_file = sys.argv[1]
-    output_image_file = sys.argv[2]
-    output_audio_file = sys.argv[3]
+    input_audio_file, output_image_file, output_audio_file = args
+    fft_func = ditfft2 if use_reference_fft else None
+    ifft_func = inverse_ditfft2 if use_reference_fft else None
 
-    # Read the audio file
-    audio_data, sample_rate = sf.read(input_audio_file)
+    # Read the audio file. Single precision is plenty, since the spectrogram is
+    # quantized when it is saved, and it halves the memory the FFTs work through.
+    audio_data, sample_rate = sf.read(input_audio_file, dtype="float32")
 
-    # If stereo, select one channel (first channel)
+    # If stereo, select one channel (first channel). Copy it out of the
+    # interleaved samples, so every window below reads contiguous memory.
     if len(audio_data.shape) > 1:
-        audio_data = audio_data[:, 0]
+        audio_data = np.ascontiguousarray(audio_data[:, 0])
 
     window_size = 1024  # Size of the FFT window
     overlap = window_size // 2
 
     # Generate and save spectrogram
-    spectrogram = audio_to_spectrogram(audio_data, window_size, overlap, ditfft2)
+    spectrogram = audio_to_spectrogram(audio_data, window_size, overlap, fft_func)
     save_spectrogram(output_image_file, spectrogram, window_size, overlap, sample_rate)
     print(f"Spectrogram saved as {output_image_file}")
 
     # Load spectrogram and reconstruct audio
     loaded_spectrogram, ws, ov, sr = load_spectrogram(output_image_file)
-    reconstructed_audio = spectrogram_to_audio(loaded_spectrogram, ws, ov)
+    reconstructed_audio = spectrogram_to_audio(loaded_spectrogram, ws, ov, ifft_func)
 
     # Save the reconstructed audio
     sf.write(output_audio_file, reconstructed_audio, sr)